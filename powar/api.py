@@ -0,0 +1,176 @@
+import dataclasses
+import os
+from typing import Callable, Iterable, Iterator, List, Optional, Union
+
+from powar.global_config import GlobalConfigManager
+from powar.module_config import ModuleConfigManager
+from powar.recorder import OperationRecorder
+from powar.settings import AppSettings
+from powar.util import realpath, rebase_path, UserError
+
+
+@dataclasses.dataclass(frozen=True)
+class RenderOp:
+    '''
+    Write a jinja template, rendered with the module's variables, to dest.
+    '''
+    module: str
+    src: str
+    dest: str
+    mode: int
+    _load: Callable[[], bytes] = dataclasses.field(repr=False,
+                                                   compare=False)
+    _fingerprint: Callable[[], str] = dataclasses.field(repr=False,
+                                                        compare=False)
+
+    def content(self) -> bytes:
+        '''
+        Render the template. Nothing is rendered until this is called.
+        '''
+        return self._load()
+
+    def fingerprint(self) -> str:
+        '''
+        Stable hash of just the variables the template reads. Together with
+        the template source, enough to key a render cache.
+        '''
+        return self._fingerprint()
+
+
+@dataclasses.dataclass(frozen=True)
+class CopyOp:
+    '''
+    Copy src verbatim to dest.
+    '''
+    module: str
+    src: str
+    dest: str
+    mode: int
+    _load: Callable[[], bytes] = dataclasses.field(repr=False,
+                                                   compare=False)
+
+    def content(self) -> bytes:
+        return self._load()
+
+
+@dataclasses.dataclass(frozen=True)
+class LinkOp:
+    '''
+    Symlink dest to src.
+    '''
+    module: str
+    src: str
+    dest: str
+
+
+@dataclasses.dataclass(frozen=True)
+class ExecOp:
+    '''
+    Run command in cwd through the shell.
+    '''
+    module: str
+    command: str
+    cwd: str
+    stdin: Optional[str] = None
+    wait: bool = True
+    stream: bool = False
+    timeout: Optional[float] = None
+
+
+Operation = Union[RenderOp, CopyOp, LinkOp, ExecOp]
+
+
+class _OperationCollector(OperationRecorder):
+    deferred = True
+
+    operations: List[Operation]
+    _settings: AppSettings
+    _directory: str
+    _module: str = ''
+
+    def __init__(self, app_settings: AppSettings, directory: str):
+        self._settings = app_settings
+        self._directory = directory
+        self.operations = []
+
+    def begin_module(self, name: str, directory: str) -> None:
+        self._module = name
+
+    def add_file(self, src: str, dest: str, content: bytes, mode: int) -> None:
+        self.operations.append(
+            CopyOp(self._module, self._src_path(src), self._dest_path(dest),
+                   mode, lambda: content))
+
+    def add_deferred_file(
+        self,
+        src: str,
+        dest: str,
+        binary: bool,
+        load: Callable[[], bytes],
+        mode: int,
+        fingerprint: Optional[Callable[[], str]] = None,
+    ) -> None:
+        if binary:
+            op: Operation = CopyOp(self._module, self._src_path(src),
+                                   self._dest_path(dest), mode, load)
+        else:
+            op = RenderOp(self._module, self._src_path(src),
+                          self._dest_path(dest), mode, load, fingerprint)
+        self.operations.append(op)
+
+    def add_link(self, src: str, dest: str) -> None:
+        self.operations.append(
+            LinkOp(self._module, self._dest_path(src), self._dest_path(dest)))
+
+    def add_command(self,
+                    command: str,
+                    stdin: Optional[str],
+                    wait: bool,
+                    stream=False,
+                    timeout: Optional[float] = None) -> None:
+        self.operations.append(
+            ExecOp(self._module, command, self._directory, stdin, wait, stream,
+                   timeout))
+
+    def _src_path(self, src: str) -> str:
+        return os.path.join(self._directory, src)
+
+    def _dest_path(self, path: str) -> str:
+        return rebase_path(realpath(path), self._settings.dest_root)
+
+
+def operations(
+    app_settings: Optional[AppSettings] = None,
+    modules: Optional[Iterable[str]] = None,
+) -> Iterator[Operation]:
+    '''
+    Evaluate global.py and then each enabled module (or only those in
+    modules), lazily yielding the operations an install would perform.
+    Modules don't write or execute anything: their commands yield ExecOps
+    and p.execute returns no output to them. global.py is evaluated as on
+    install, so its p.execute calls do run unless app_settings.dry_run is
+    set.
+    '''
+    app_settings = dataclasses.replace(app_settings or AppSettings())
+    for var in ("template_dir", "config_dir", "cache_dir"):
+        app_settings[var] = realpath(app_settings[var])
+
+    global_config = GlobalConfigManager(
+        app_settings.config_dir,
+        app_settings,
+    ).get_global_config()
+
+    names = global_config.modules
+    if modules is not None:
+        names = list(modules)
+        unknown = set(names) - set(global_config.modules)
+        if unknown:
+            raise UserError(*(f"module \"{module}\" is not enabled"
+                              for module in unknown))
+
+    for module in names:
+        directory = os.path.join(app_settings.template_dir, module)
+        collector = _OperationCollector(app_settings, directory)
+        ModuleConfigManager(directory, global_config, app_settings,
+                            collector).run()
+        yield from collector.operations
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+from typing import Any, Dict, List, Optional, Set
+
+from powar.recorder import OperationRecorder
+from powar.settings import AppSettings
+from powar.util import realpath, run_command, can_install_without_root, rebase_path, UserError
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+BUNDLE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+BLOB_DIR = 'blobs'
+
+
+def _blob_name(digest: str) -> str:
+    return f'{BLOB_DIR}/{digest}'
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BundleWriter(OperationRecorder):
+    '''
+    Records the operations of evaluated modules into a single zip artifact:
+    a JSON manifest plus content-addressed blobs.
+    '''
+    _path: str
+    _zip: zipfile.ZipFile
+    _blobs: Set[str]
+    _modules: List[Dict[str, Any]]
+    _current: Optional[Dict[str, Any]] = None
+    _current_dests: List[str]
+
+    def __init__(self, path: str):
+        self._path = path
+        self._zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._blobs = set()
+        self._modules = []
+        self._current_dests = []
+
+    def __enter__(self) -> 'BundleWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._zip.close()
+            os.remove(self._path)
+
+    def begin_module(self, name: str, directory: str) -> None:
+        # commands run from here on apply, as they do on install
+        self._current = {'name': name, 'directory': directory, 'ops': []}
+        self._current_dests = []
+        self._modules.append(self._current)
+
+    def add_file(self, src: str, dest: str, content: bytes, mode: int) -> None:
+        digest = hashlib.sha256(content).hexdigest()
+        if digest not in self._blobs:
+            self._zip.writestr(_blob_name(digest), content)
+            self._blobs.add(digest)
+        self._add_op({
+            'op': 'file',
+            'src': src,
+            'dest': dest,
+            'blob': digest,
+            'size': len(content),
+            'mode': mode,
+        })
+        self._current_dests.append(dest)
+
+    def add_link(self, src: str, dest: str) -> None:
+        self._add_op({'op': 'link', 'src': src, 'dest': dest})
+        self._current_dests.append(dest)
+
+    def add_command(self,
+                    command: str,
+                    stdin: Optional[str],
+                    wait: bool,
+                    stream=False,
+                    timeout: Optional[float] = None) -> None:
+        # A command only reruns on apply if something the module installed
+        # before it changed; commands preceding any install always run.
+        self._add_op({
+            'op': 'exec',
+            'command': command,
+            'stdin': stdin,
+            'wait': wait,
+            'stream': stream,
+            'timeout': timeout,
+            'guard': list(self._current_dests),
+        })
+
+    def close(self) -> None:
+        manifest = {
+            'version': BUNDLE_VERSION,
+            'created': time.time(),
+            'modules': self._modules,
+        }
+        self._zip.writestr(MANIFEST_NAME, json.dumps(manifest, indent=1))
+        self._zip.close()
+
+    def _add_op(self, op: Dict[str, Any]) -> None:
+        if self._current is None:
+            raise RuntimeError("begin_module() must be called before adding ops")
+        self._current['ops'].append(op)
+
+
+class BundleApplier:
+    '''
+    Applies a bundle produced by BundleWriter, touching only destinations
+    whose size or hash differs from the bundled content.
+    '''
+    _path: str
+    _settings: AppSettings
+    _cwd: str
+
+    def __init__(self, path: str, app_settings: AppSettings):
+        self._path = path
+        self._settings = app_settings
+        self._cwd = realpath('~')
+
+    def run(self) -> None:
+        try:
+            bundle = zipfile.ZipFile(self._path, 'r')
+        except (OSError, zipfile.BadZipFile) as e:
+            raise UserError(f"cannot open bundle {self._path}: {e}")
+
+        with bundle:
+            try:
+                manifest = json.loads(bundle.read(MANIFEST_NAME))
+            except (KeyError, ValueError):
+                raise UserError(f"{self._path} is not a powar bundle")
+            if manifest.get('version') != BUNDLE_VERSION:
+                raise UserError(
+                    f"unsupported bundle version {manifest.get('version')} " \
+                    f"in {self._path}")
+
+            for module in manifest['modules']:
+                self._apply_module(bundle, module)
+
+    def _dest_path(self, path: str) -> str:
+        return rebase_path(realpath(path), self._settings.dest_root)
+
+    def _apply_module(self, bundle: zipfile.ZipFile,
+                      module: Dict[str, Any]) -> None:
+        changed: Set[str] = set()
+        cwd = module.get('directory')
+        if cwd is None or not os.path.isdir(cwd):
+            cwd = self._cwd
+            if any(op['op'] == 'exec' for op in module['ops']):
+                logger.warn(
+                    f"module directory of \"{module['name']}\" doesn't exist " \
+                    f"here, running its commands from {cwd}")
+
+        for op in module['ops']:
+            kind = op['op']
+            if kind == 'file':
+                if self._apply_file(bundle, op):
+                    changed.add(op['dest'])
+            elif kind == 'link':
+                if self._apply_link(op):
+                    changed.add(op['dest'])
+            elif kind == 'exec':
+                if op['guard'] and not changed.intersection(op['guard']):
+                    logger.info(
+                        f"Skipped (unchanged): {op['command']} for {module['name']}"
+                    )
+                    continue
+                self._apply_command(op, module['name'], cwd)
+            else:
+                raise UserError(f"unknown bundle operation: {kind}")
+
+    def _apply_file(self, bundle: zipfile.ZipFile, op: Dict[str, Any]) -> bool:
+        dest = self._dest_path(op['dest'])
+
+        try:
+            st = os.stat(dest)
+            unchanged = st.st_size == op['size'] \
+                and _file_digest(dest) == op['blob']
+        except FileNotFoundError:
+            unchanged = False
+
+        if unchanged:
+            if st.st_mode & 0o7777 != op['mode'] and not self._settings.dry_run:
+                os.chmod(dest, op['mode'])
+            logger.info(f"Unchanged: {dest}")
+            return False
+
+        content = bundle.read(_blob_name(op['blob']))
+        if not self._settings.dry_run:
+            if can_install_without_root(dest):
+                self._write_file(dest, content, op['mode'])
+            elif self._settings.switch_to_root:
+                cwd = self._cwd
+                run_command(f"sudo -E mkdir -p {os.path.dirname(dest)}", cwd)
+                run_command(f"sudo -E tee {dest}", cwd, stdin=content)
+                run_command(f"sudo -E chmod {op['mode']:o} {dest}", cwd)
+            else:
+                logger.warn(
+                    f"installing at \"{dest}\" requires to be in root mode, skipping"
+                )
+                return False
+        logger.info(f"Done: {op['src']} -> {dest}")
+        return True
+
+    def _write_file(self, dest: str, content: bytes, mode: int) -> None:
+        dest_dir = os.path.dirname(dest)
+        os.makedirs(dest_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dest_dir, prefix='.powar-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp, mode)
+            os.replace(tmp, dest)
+        except:
+            os.remove(tmp)
+            raise
+
+    def _apply_link(self, op: Dict[str, Any]) -> bool:
+        dest = self._dest_path(op['dest'])
+        target = rebase_path(op['src'], self._settings.dest_root)
+        if os.path.islink(dest) and os.readlink(dest) == target:
+            logger.info(f"Unchanged: {dest}")
+            return False
+
+        if not self._settings.dry_run:
+            dest_dir = os.path.dirname(dest)
+            os.makedirs(dest_dir, exist_ok=True)
+            tmp = os.path.join(dest_dir,
+                               f'.powar-{os.getpid()}-{os.path.basename(dest)}')
+            os.symlink(target, tmp)
+            os.replace(tmp, dest)
+        logger.info(f"Linked: {target} -> {dest}")
+        return True
+
+    def _apply_command(self, op: Dict[str, Any], module_name: str,
+                       cwd: str) -> None:
+        if not self._settings.dry_run:
+            stdin = op['stdin']
+            run_command(op['command'],
+                        cwd,
+                        stdin.encode('utf8') if stdin else None,
+                        wait=op['wait'],
+                        stream=op.get('stream', False),
+                        timeout=op.get('timeout'))
+        logger.info(
+            f"Ran{'' if op['wait'] else ' (in bg)'}: {op['command']} for {module_name}"
+        )
@@ -6,14 +6,29 @@ from typing import Iterable, Optional, Set, List, Dict, Any, Union, Tuple
 from getpass import getuser
 
 from powar.settings import AppSettings
-from powar.util import saved_sys_properties, read_header, run_command, RunCommandResult, realpath
+from powar.snapshot import OptsSnapshot
+from powar.util import saved_sys_properties, compile_file, read_header, run_command, RunCommandResult, realpath
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 
 class GlobalConfig:
     modules: List[str]
-    opts: Dict[Any, Any] = {}
+    opts: Dict[Any, Any]
+
+    _snapshot: Optional[OptsSnapshot] = None
+
+    def __init__(self):
+        self.modules = []
+        self.opts = {}
+
+    def snapshot(self) -> OptsSnapshot:
+        '''
+        Frozen copy of opts, taken on first use and shared from then on
+        '''
+        if self._snapshot is None:
+            self._snapshot = OptsSnapshot(self.opts)
+        return self._snapshot
 
 
 class GlobalConfigApi:
@@ -34,11 +49,15 @@ class GlobalConfigApi:
         stdin: Optional[str] = None,
         decode_stdout=True,
         wait=True,
+        stream=False,
+        timeout: Optional[float] = None,
     ) -> RunCommandResult:
         '''
-        Run command and return stdout if any
+        Run command and return stdout if any. With stream, output is echoed
+        line by line and only its tail is returned.
         '''
-        return self._man.execute_command(command, stdin, decode_stdout, wait)
+        return self._man.execute_command(command, stdin, decode_stdout, wait,
+                                         stream, timeout)
 
     def read(self, filename: str, as_bytes=False) -> Union[str, bytes]:
         return self._man.read_file(filename, as_bytes)
@@ -50,7 +69,7 @@ class GlobalConfigManager:
     _api: GlobalConfigApi
     _modules: List = []
 
-    _global_config: GlobalConfig = GlobalConfig()
+    _global_config: GlobalConfig
 
     _config_path: str
     _header: Optional[Dict[Any, Any]] = None
@@ -62,6 +81,7 @@ class GlobalConfigManager:
     ):
         self._directory = directory
         self._settings = app_settings
+        self._global_config = GlobalConfig()
 
         self._config_path = os.path.join(self._directory,
                                          app_settings.global_config_filename)
@@ -73,10 +93,7 @@ class GlobalConfigManager:
         module.p = api  # type: ignore
         module.__file__ = self._config_path
 
-        with open(self._config_path, 'rb') as f:
-            source = f.read()
-
-        code = compile(source, self._config_path, 'exec')
+        code = compile_file(self._config_path)
 
         # Save and restore sys variables and cwd
         old_cwd = os.getcwd()
@@ -90,13 +107,18 @@ class GlobalConfigManager:
         self._global_config.modules = self._modules
         return self._global_config
 
-    def execute_command(self, command: str, stdin: Optional[str],
-                        decode_stdout: bool, wait: bool) -> RunCommandResult:
+    def execute_command(self,
+                        command: str,
+                        stdin: Optional[str],
+                        decode_stdout: bool,
+                        wait: bool,
+                        stream=False,
+                        timeout: Optional[float] = None) -> RunCommandResult:
         result = RunCommandResult(stdout=None, code=0)
         if not self._settings.dry_run:
             result = run_command(command, self._directory,
                                  stdin.encode('utf8') if stdin else None,
-                                 decode_stdout, wait)
+                                 decode_stdout, wait, stream, timeout)
         logger.info(
             f"Ran{'' if wait else ' (in bg)'}: {command} for {self._config_path}"
         )
@@ -7,7 +7,10 @@ import sys
 import subprocess
 from typing import cast, Iterable
 
+from powar.bundle import BundleWriter, BundleApplier
 from powar.module_config import ModuleConfigManager
+from powar.matrix import run_matrix
+from powar.packages import check_system_packages
 from powar.global_config import GlobalConfigManager, GlobalConfig
 from powar.settings import AppSettings, AppMode, AppLogLevel
 from powar.util import realpath, UserError
@@ -48,6 +51,30 @@ def parse_args_into(app_settings: AppSettings) -> argparse.ArgumentParser:
         "run powar in sudo mode to be able to install files in places outside $HOME",
     )
 
+    parser.add_argument(
+        "--dest-root",
+        dest="dest_root",
+        help="install files and links under this directory instead of / " \
+        "(commands still run against the live system)",
+    )
+
+    parser.add_argument(
+        "--install-jobs",
+        dest="install_jobs",
+        type=int,
+        help="number of threads rendering and writing the entries of " \
+        "each install call (default: %(default)s)",
+        default=app_settings.install_jobs,
+    )
+
+    parser.add_argument(
+        "--package-backend",
+        dest="package_backend",
+        help="how to check modules' system_packages: auto, none, pacman, " \
+        "dpkg or file:PATH (default: %(default)s)",
+        default=app_settings.package_backend,
+    )
+
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
         "-q",
@@ -100,6 +127,58 @@ def parse_args_into(app_settings: AppSettings) -> argparse.ArgumentParser:
     )
     parser_init.set_defaults(mode=AppMode.INIT)
 
+    # Bundle mode
+    parser_bundle = subparsers.add_parser(
+        "bundle",
+        help="evaluate all modules and write the result to a bundle file",
+    )
+    parser_bundle.set_defaults(mode=AppMode.BUNDLE)
+    parser_bundle.add_argument(
+        "bundle_path",
+        metavar="BUNDLE",
+        help="path of the bundle file to create",
+    )
+
+    # Apply mode
+    parser_apply = subparsers.add_parser(
+        "apply",
+        help="apply a bundle created with `powar bundle`",
+    )
+    parser_apply.set_defaults(mode=AppMode.APPLY)
+    parser_apply.add_argument(
+        "bundle_path",
+        metavar="BUNDLE",
+        help="path of the bundle file to apply",
+    )
+
+    # Render mode
+    parser_render = subparsers.add_parser(
+        "render",
+        help="render all modules for every profile in a profiles file, " \
+        "without running commands",
+    )
+    parser_render.set_defaults(mode=AppMode.RENDER)
+    parser_render.add_argument(
+        "profiles_path",
+        metavar="PROFILES",
+        help="YAML file mapping profile names to opts overrides " \
+        "and/or a global.py variant",
+    )
+    parser_render.add_argument(
+        "-o",
+        "--output",
+        dest="output_dir",
+        required=True,
+        help="directory under which each profile is rendered",
+    )
+    parser_render.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        help="number of worker processes (default: number of CPUs)",
+    )
+
     parser.parse_args(namespace=app_settings)
     return parser
 
@@ -159,11 +238,23 @@ def run_new_module(app_settings: AppSettings) -> None:
 
 def run_install(app_settings: AppSettings, module_directories: Iterable[str],
                 global_config: GlobalConfig) -> None:
+    module_directories = list(module_directories)
+    check_system_packages(app_settings, module_directories)
     for directory in module_directories:
         manager = ModuleConfigManager(directory, global_config, app_settings)
         manager.run()
 
 
+def run_bundle(app_settings: AppSettings, module_directories: Iterable[str],
+               global_config: GlobalConfig) -> None:
+    with BundleWriter(app_settings.bundle_path) as bundle:
+        for directory in module_directories:
+            manager = ModuleConfigManager(directory, global_config,
+                                          app_settings, bundle)
+            manager.run()
+    print(f"{app_settings.bundle_path} created.")
+
+
 def main() -> None:
     app_settings = AppSettings()
     parser = parse_args_into(app_settings)
@@ -182,6 +273,16 @@ def main() -> None:
         if not os.path.isabs(app_settings[var]):
             parser.error(f"{var} needs to be absolute")
 
+    if app_settings.jobs is not None and app_settings.jobs < 1:
+        parser.error("--jobs needs to be at least 1")
+
+    if app_settings.install_jobs < 1:
+        parser.error("--install-jobs needs to be at least 1")
+
+    if app_settings.dest_root is not None:
+        app_settings.dest_root = os.path.abspath(
+            realpath(app_settings.dest_root))
+
     try:
         if app_settings.mode == AppMode.INIT:
             return run_init(app_settings)
@@ -189,6 +290,22 @@ def main() -> None:
         if app_settings.mode == AppMode.NEW_MODULE:
             return run_new_module(app_settings)
 
+        if app_settings.mode == AppMode.APPLY:
+            return BundleApplier(app_settings.bundle_path, app_settings).run()
+
+        if app_settings.mode == AppMode.RENDER:
+            for var in ("profiles_path", "output_dir"):
+                app_settings[var] = os.path.abspath(realpath(app_settings[var]))
+            results = run_matrix(app_settings)
+            failed = [r.name for r in results if r.error is not None]
+            if failed:
+                logger.error(
+                    f"{len(failed)} of {len(results)} profiles failed: " \
+                    f"{', '.join(failed)}")
+                # CI relies on the exit status
+                sys.exit(1)
+            return
+
         # cache_man = CacheManager(app_settings.cache_dir)
 
         global_config = GlobalConfigManager(
@@ -208,6 +325,9 @@ def main() -> None:
 
             return run_install(app_settings, directories, global_config)
 
+        if app_settings.mode == AppMode.BUNDLE:
+            return run_bundle(app_settings, directories, global_config)
+
     except UserError as error:
         for arg in error.args:
             logger.error(arg)
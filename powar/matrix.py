@@ -0,0 +1,184 @@
+import dataclasses
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import yaml
+
+from powar.global_config import GlobalConfigManager
+from powar.module_config import ModuleConfigManager
+from powar.recorder import OperationRecorder
+from powar.settings import AppSettings
+from powar.util import realpath, rebase_path, compile_file, UserError
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Profile:
+    name: str
+    opts: Dict[Any, Any]
+    global_config_path: Optional[str] = None
+
+
+@dataclasses.dataclass
+class ProfileResult:
+    name: str
+    files: int
+    seconds: float
+    error: Optional[str] = None
+
+
+class DirectoryRecorder(OperationRecorder):
+    '''
+    Writes rendered files and links under an output root instead of their
+    real destinations. Commands are never run.
+    '''
+    _root: str
+    files: int = 0
+
+    def __init__(self, root: str):
+        self._root = root
+
+    def begin_module(self, name: str, directory: str) -> None:
+        pass
+
+    def add_file(self, src: str, dest: str, content: bytes, mode: int) -> None:
+        path = self._rebase(dest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.chmod(path, mode)
+        self.files += 1
+
+    def add_link(self, src: str, dest: str) -> None:
+        path = self._rebase(dest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        # point at the rendered tree rather than the live system
+        os.symlink(rebase_path(realpath(src), self._root), path)
+        self.files += 1
+
+    def add_command(self,
+                    command: str,
+                    stdin: Optional[str],
+                    wait: bool,
+                    stream=False,
+                    timeout: Optional[float] = None) -> None:
+        pass
+
+    def _rebase(self, dest: str) -> str:
+        return rebase_path(os.path.abspath(realpath(dest)), self._root)
+
+
+def read_profiles(path: str) -> List[Profile]:
+    '''
+    Read a YAML mapping of profile names to `opts` overrides and/or a
+    `global` path pointing to a global.py variant.
+    '''
+    with open(path, 'r') as f:
+        data = yaml.safe_load(f)
+    if not isinstance(data, dict):
+        raise UserError(f"invalid profiles file {path}")
+
+    profiles = []
+    for name, spec in data.items():
+        spec = spec or {}
+        if not isinstance(spec, dict):
+            raise UserError(f"invalid profile \"{name}\" in {path}")
+        global_path = spec.get('global')
+        if global_path is not None:
+            global_path = os.path.join(os.path.dirname(path),
+                                       realpath(global_path))
+        profiles.append(
+            Profile(str(name), spec.get('opts') or {}, global_path))
+    return profiles
+
+
+def _render_profile(args: Tuple[Profile, AppSettings]) -> ProfileResult:
+    profile, app_settings = args
+    start = time.perf_counter()
+    recorder = DirectoryRecorder(
+        os.path.join(app_settings.output_dir, profile.name))
+
+    settings = app_settings
+    if profile.global_config_path is not None:
+        settings = dataclasses.replace(
+            app_settings,
+            config_dir=os.path.dirname(profile.global_config_path),
+            global_config_filename=os.path.basename(
+                profile.global_config_path),
+        )
+
+    try:
+        global_config = GlobalConfigManager(
+            settings.config_dir,
+            settings,
+        ).get_global_config()
+        global_config.opts.update(profile.opts)
+
+        for module in global_config.modules:
+            directory = os.path.join(settings.template_dir, module)
+            ModuleConfigManager(directory, global_config, settings,
+                                recorder).run()
+    except Exception as e:
+        error = ' '.join(map(str, e.args)) if isinstance(e, UserError) \
+            else traceback.format_exc()
+        return ProfileResult(profile.name, recorder.files,
+                             time.perf_counter() - start, error)
+
+    return ProfileResult(profile.name, recorder.files,
+                         time.perf_counter() - start)
+
+
+def _precompile(app_settings: AppSettings, profiles: List[Profile]) -> None:
+    '''
+    Compile every config file up front so that forked workers inherit the
+    code objects instead of compiling them once per profile.
+    '''
+    paths = [
+        os.path.join(app_settings.config_dir,
+                     app_settings.global_config_filename)
+    ]
+    paths += [p.global_config_path for p in profiles if p.global_config_path]
+    if os.path.isdir(app_settings.template_dir):
+        for module in os.listdir(app_settings.template_dir):
+            paths.append(
+                os.path.join(app_settings.template_dir, module,
+                             app_settings.module_config_filename))
+
+    for path in paths:
+        try:
+            compile_file(path)
+        except (OSError, SyntaxError):
+            # reported per profile when actually used
+            pass
+
+
+def run_matrix(app_settings: AppSettings) -> List[ProfileResult]:
+    profiles = read_profiles(app_settings.profiles_path)
+    _precompile(app_settings, profiles)
+
+    jobs = [(profile, app_settings) for profile in profiles]
+    workers = app_settings.jobs or os.cpu_count() or 1
+    # chunks keep each worker's template cache warm across profiles
+    chunksize = max(1, len(jobs) // (4 * workers))
+    # _precompile only pays off if workers inherit the parent's caches
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('fork')) as pool:
+        results = list(pool.map(_render_profile, jobs, chunksize=chunksize))
+
+    for result in results:
+        if result.error is None:
+            print(f"{result.name}: {result.files} files " \
+                  f"in {result.seconds:.2f}s")
+        else:
+            logger.error(f"Failed: {result.name} ({result.seconds:.2f}s)\n" \
+                         f"{result.error}")
+    return results
@@ -2,25 +2,28 @@ import logging
 import types
 import os
 import sys
-from typing import Tuple, Iterable, Optional, Set, List, Dict, Any, Union
-from getpass import getuser
-from pwd import getpwuid
+from typing import Tuple, Iterable, Iterator, Optional, Set, List, Dict, Any, Union, Mapping
 import subprocess
+import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from powar.global_config import GlobalConfig
 from powar.settings import AppSettings
-from powar.util import saved_sys_properties, render_template, realpath, read_header, run_command, UserError, RunCommandResult
+from powar.recorder import OperationRecorder
+from powar.snapshot import OptsSnapshot, OptsReader, freeze, structural_hash
+from powar.util import saved_sys_properties, compile_file, render_template, realpath, read_header, run_command, UserError, RunCommandResult, can_install_without_root, rebase_path, template_names
 
 logger: logging.Logger = logging.getLogger(__name__)
 
 
 class ModuleConfigApi:
-    opts: Dict[Any, Any]
+    opts: Mapping[Any, Any]
     local: Dict[Any, Any]
 
     _man: 'ModuleConfigManager'
 
-    def __init__(self, man: 'ModuleConfigManager', opts: Dict[Any, Any],
+    def __init__(self, man: 'ModuleConfigManager', opts: Mapping[Any, Any],
                  local: Dict[Any, Any]):
         self.opts = opts
         self.local = local
@@ -79,11 +82,15 @@ class ModuleConfigApi:
         stdin: Optional[str] = None,
         decode_stdout=True,
         wait=True,
+        stream=False,
+        timeout: Optional[float] = None,
     ) -> Union[int, Tuple[Union[str, bytes], int]]:
         '''
-        Run command and return stdout if any
+        Run command and return stdout if any. With stream, output is echoed
+        line by line and only its tail is returned.
         '''
-        result = self._man.execute_command(command, stdin, decode_stdout, wait)
+        result = self._man.execute_command(command, stdin, decode_stdout, wait,
+                                           stream, timeout)
         return result.stdout, result.code 
 
     def has(self, module: str) -> bool:
@@ -104,11 +111,13 @@ class ModuleConfigManager:
     _settings: AppSettings
     _global_config: GlobalConfig
     _api: ModuleConfigApi
+    _recorder: Optional[OperationRecorder]
 
-    _current_user: str = getuser()
+    _sudo_lock: threading.Lock = threading.Lock()
 
-    _opts: Dict[Any, Any]
-    _local: Dict[Any, Any] = {}
+    _snapshot: OptsSnapshot
+    _opts: OptsReader
+    _local: Dict[Any, Any]
 
     _module_name: str
     _config_path: str
@@ -118,12 +127,17 @@ class ModuleConfigManager:
         directory: str,
         global_config: GlobalConfig,
         app_settings: AppSettings,
+        recorder: Optional[OperationRecorder] = None,
     ):
         self._directory = directory
         self._global_config = global_config
         self._settings = app_settings
+        self._recorder = recorder
 
-        self._opts = global_config.opts
+        # read-only for modules, so that nothing leaks from one to the next
+        self._snapshot = global_config.snapshot()
+        self._opts = self._snapshot.reader()
+        self._local = {}
 
         self._module_name = os.path.basename(self._directory)
         self._config_path = os.path.join(self._directory,
@@ -135,14 +149,15 @@ class ModuleConfigManager:
     def run(self) -> None:
         api = ModuleConfigApi(self, self._opts, self._local)
 
+        if self._recorder is not None:
+            self._recorder.begin_module(self._module_name,
+                                        self._directory)
+
         module = types.ModuleType('powar')
         module.p = api  # type: ignore
         module.__file__ = self._config_path
 
-        with open(self._config_path, 'rb') as f:
-            source = f.read()
-
-        code = compile(source, self._config_path, 'exec')
+        code = compile_file(self._config_path)
 
         # Save and restore sys variables and cwd
         old_cwd = os.getcwd()
@@ -169,36 +184,106 @@ class ModuleConfigManager:
     def install_entries(self,
                         entries: Iterable[Tuple[str, str]],
                         binary=False) -> None:
-        dir_files = os.listdir(self._directory)
+        entries = list(entries)
 
-        if binary:
-            for src, dest in entries:
-                self._install_bin(src, dest)
-        else:
+        # When several entries share a destination, only the last one is
+        # kept, as it is the one that would have won installing them in turn
+        last = {self._dest_path(dest): i for i, (_, dest) in enumerate(entries)}
+        entries = [entries[i] for i in sorted(last.values())]
+
+        # shared by all entries, and as they are now for deferred renders
+        variables = None if binary else self._template_variables()
+
+        if self._recorder is not None and self._recorder.deferred:
             for src, dest in entries:
-                with open(os.path.join(self._directory, src), 'r') as f:
-                    src_contents = f.read()
-                rendered = self.render_template(src_contents)
-                self._install_file(src, dest, content=rendered)
+                self._record_deferred_file(src, dest, binary, variables)
+            return
+
+        # Entries are rendered and written by a pool of threads, but results
+        # are consumed in order so that logs and the first error reported
+        # don't depend on scheduling.
+        with ThreadPoolExecutor(self._settings.install_jobs) as pool:
+            if self._recorder is not None:
+                futures = [
+                    pool.submit(self._read_source, src, binary, variables)
+                    for src, _ in entries
+                ]
+                for (src, dest), content in zip(
+                        entries, self._results_in_order(futures)):
+                    self._record_file(src, dest, content)
+                return
+
+            if binary:
+                futures = [
+                    pool.submit(self._install_bin, src, dest)
+                    for src, dest in entries
+                ]
+            else:
+                futures = [
+                    pool.submit(self._install_file, src, dest, variables)
+                    for src, dest in entries
+                ]
+            for level, message in self._results_in_order(futures,
+                                                         report_late=True):
+                logger.log(level, message)
+
+    def _results_in_order(
+        self,
+        futures: List[Future],
+        report_late=False,
+    ) -> Iterator[Any]:
+        '''
+        Yield the results of futures in order. On the first failure, cancel
+        the futures that haven't started and, if report_late, still log the
+        ones that were already under way and succeeded before re-raising.
+        '''
+        for i, future in enumerate(futures):
+            try:
+                result = future.result()
+            except:
+                later = futures[i + 1:]
+                for f in later:
+                    f.cancel()
+                if report_late:
+                    for f in later:
+                        if not f.cancelled() and f.exception() is None:
+                            logger.log(*f.result())
+                raise
+            yield result
 
     def link_entries(
         self,
         entries: Iterable[Tuple[str, str]],
     ) -> None:
         for src, dest in entries:
+            if self._recorder is not None:
+                self._recorder.add_link(realpath(src), dest)
+                logger.info(f"Recorded link: {src} -> {dest}")
+                continue
             if not self._settings.dry_run:
-                dest_dir = realpath(os.path.dirname(dest))
+                dest_dir = os.path.dirname(self._dest_path(dest))
                 dest_file = os.path.basename(dest)
                 run_command(f'mkdir -p {dest_dir}', self._directory)
-                run_command(f'ln -Fs {realpath(src)} ./{dest_file}', dest_dir)
-            logger.info(f"Linked: {src} -> {dest}")
-
-    def execute_command(self, command: str, stdin: Optional[str],
-                        decode_stdout: bool, wait: bool) -> RunCommandResult:
+                run_command(f'ln -Fs {self._dest_path(src)} ./{dest_file}',
+                            dest_dir)
+            logger.info(f"Linked: {src} -> {self._dest_path(dest)}")
+
+    def execute_command(self,
+                        command: str,
+                        stdin: Optional[str],
+                        decode_stdout: bool,
+                        wait: bool,
+                        stream=False,
+                        timeout: Optional[float] = None) -> RunCommandResult:
         result = RunCommandResult(stdout=None, code=0)
+        if self._recorder is not None:
+            self._recorder.add_command(command, stdin, wait, stream, timeout)
+            logger.info(f"Recorded: {command} for {self._config_path}")
+            return result
         if not self._settings.dry_run:
-            result = run_command(command, self._directory, stdin,
-                                 decode_stdout, wait)
+            result = run_command(command, self._directory,
+                                 stdin.encode('utf8') if stdin else None,
+                                 decode_stdout, wait, stream, timeout)
         logger.info(
             f"Ran{'' if wait else ' (in bg)'}: {command} for {self._config_path}"
         )
@@ -213,54 +298,123 @@ class ModuleConfigManager:
     ) -> str:
         return render_template(
             contents,
-            variables={
-                'local': self._local,
-                **self._opts,
-            },
+            variables=self._template_variables(),
             directory=self._directory,
         )
 
-    def _can_install_without_root(self, dest: str) -> bool:
-        try:
-            owner_of_dest = getpwuid(os.stat(dest).st_uid).pw_name
-        except FileNotFoundError:
-            owner_of_dest = getpwuid(os.stat(
-                os.path.dirname(dest)).st_uid).pw_name
-
-        if not owner_of_dest == self._current_user:
-            return False
-        return True
+    def opts_fingerprint(self) -> str:
+        '''
+        Hash of the opts this module has read so far
+        '''
+        return self._opts.fingerprint()
 
-    def _get_install_prefix(self, dest: str) -> str:
+    def template_fingerprint(
+        self,
+        contents: str,
+        variables: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        '''
+        Hash of the variables a template reads, falling back to all of them
+        when that can't be determined statically
+        '''
+        if variables is None:
+            variables = self._template_variables()
+        names = template_names(contents, self._directory)
+        if names is None:
+            names = frozenset(self._snapshot.data) | {'local'}
+
+        h = hashlib.sha256(
+            self._snapshot.fingerprint(names - {'local'}).encode())
+        if 'local' in names:
+            h.update(structural_hash(variables['local']).encode())
+        return h.hexdigest()
+
+    def _template_variables(self) -> Dict[str, Any]:
+        return {
+            'local': freeze(self._local),
+            **self._snapshot.data,
+        }
+
+    def _dest_path(self, path: str) -> str:
+        return rebase_path(realpath(path), self._settings.dest_root)
+
+    def _get_install_prefix(self, dest: str) -> Optional[str]:
         prefix = ''
-        if not self._can_install_without_root(dest):
+        if not can_install_without_root(dest):
             if not self._settings.switch_to_root:
-                logger.warn(
-                    f"installing at \"{dest}\" requires to be in root mode, skipping"
-                )
-                return
+                return None
             prefix = 'sudo -E'
         return prefix
 
-    def _install_file(self, src: str, dest: str, content: str) -> None:
-        dest = realpath(dest)
+    def _read_source(
+        self,
+        src: str,
+        binary: bool,
+        variables: Optional[Dict[str, Any]],
+    ) -> bytes:
+        path = os.path.join(self._directory, src)
+        if binary:
+            with open(path, 'rb') as f:
+                return f.read()
+        with open(path, 'r') as f:
+            src_contents = f.read()
+        rendered = render_template(src_contents, variables, self._directory)
+        return str.encode(rendered + '\n')
+
+    def _record_deferred_file(
+        self,
+        src: str,
+        dest: str,
+        binary: bool,
+        variables: Optional[Dict[str, Any]],
+    ) -> None:
+        path = os.path.join(self._directory, src)
+        mode = os.stat(path).st_mode & 0o7777
+
+        def fingerprint() -> str:
+            with open(path, 'r') as f:
+                return self.template_fingerprint(f.read(), variables)
+
+        self._recorder.add_deferred_file(
+            src, dest, binary, lambda: self._read_source(src, binary, variables),
+            mode, None if binary else fingerprint)
+        logger.info(f"Recorded: {src} -> {dest}")
+
+    def _record_file(self, src: str, dest: str, content: bytes) -> None:
+        mode = os.stat(os.path.join(self._directory, src)).st_mode & 0o7777
+        self._recorder.add_file(src, dest, content, mode)
+        logger.info(f"Recorded: {src} -> {dest}")
+
+    def _install_file(self, src: str, dest: str,
+                      variables: Dict[str, Any]) -> Tuple[int, str]:
+        content = self._read_source(src, False, variables)
+        return self._copy_file(src, dest, content, "Done")
+
+    def _install_bin(self, src: str, dest: str) -> Tuple[int, str]:
+        return self._copy_file(src, dest, None, "Done (bin)")
+
+    def _copy_file(self, src: str, dest: str, content: Optional[bytes],
+                   done: str) -> Tuple[int, str]:
+        dest = self._dest_path(dest)
         prefix = self._get_install_prefix(dest)
+        if prefix is None:
+            return logging.WARNING, \
+                f"installing at \"{dest}\" requires to be in root mode, skipping"
 
-        if not self._settings.dry_run:
+        def copy() -> None:
             run_command(f'{prefix} mkdir -p {os.path.dirname(dest)}',
                         self._directory)
             run_command(f'{prefix} cp {src} {dest}', self._directory)
-            run_command(f'{prefix} tee {dest}',
-                        self._directory,
-                        stdin=str.encode(content + '\n'))
-        logger.info(f"Done: {src} -> {dest}")
-
-    def _install_bin(self, src: str, dest: str) -> None:
-        dest = realpath(dest)
-        prefix = self._get_install_prefix(dest)
+            if content is not None:
+                run_command(f'{prefix} tee {dest}',
+                            self._directory,
+                            stdin=content)
 
         if not self._settings.dry_run:
-            run_command(f'{prefix} mkdir -p {os.path.dirname(dest)}',
-                        self._directory)
-            run_command(f'{prefix} cp {src} {dest}', self._directory)
-        logger.info(f"Done (bin): {src} -> {dest}")
+            if prefix:
+                # only one sudo may prompt for a password at a time
+                with self._sudo_lock:
+                    copy()
+            else:
+                copy()
+        return logging.INFO, f"{done}: {src} -> {dest}"
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import shutil
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Set
+
+from powar.settings import AppSettings
+from powar.util import read_header, run_command, UserError
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class PackageBackend(ABC):
+    name: str
+
+    @abstractmethod
+    def database_path(self) -> str:
+        '''
+        Path whose mtime changes whenever the set of installed packages does
+        '''
+        pass
+
+    @abstractmethod
+    def installed(self) -> Set[str]:
+        pass
+
+    def _query(self, command: str) -> str:
+        result = run_command(command, '/')
+        if result.code:
+            raise UserError(f"{command} failed with exit code {result.code}")
+        return result.stdout
+
+
+class PacmanBackend(PackageBackend):
+    name = 'pacman'
+
+    def database_path(self) -> str:
+        return '/var/lib/pacman/local'
+
+    def installed(self) -> Set[str]:
+        return set(self._query('pacman -Qq').split())
+
+
+class DpkgBackend(PackageBackend):
+    name = 'dpkg'
+
+    def database_path(self) -> str:
+        return '/var/lib/dpkg/status'
+
+    def installed(self) -> Set[str]:
+        stdout = self._query(
+            "dpkg-query -W -f='${db:Status-Abbrev} ${Package}\\n'")
+        return {
+            line.split()[-1]
+            for line in stdout.splitlines()
+            if line.startswith('ii')
+        }
+
+
+class FileBackend(PackageBackend):
+    '''
+    Reads installed package names from a file, one per line. Useful to
+    stub the check out on machines without a supported package manager.
+    '''
+    name = 'file'
+    _path: str
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def database_path(self) -> str:
+        return self._path
+
+    def installed(self) -> Set[str]:
+        with open(self._path, 'r') as f:
+            return {line.strip() for line in f if line.strip()}
+
+
+def get_backend(spec: str) -> Optional[PackageBackend]:
+    '''
+    Resolve a backend from "auto", "none", "pacman", "dpkg" or "file:PATH".
+    '''
+    if spec == 'none':
+        return None
+    if spec == 'pacman':
+        return PacmanBackend()
+    if spec == 'dpkg':
+        return DpkgBackend()
+    if spec.startswith('file:'):
+        return FileBackend(spec[len('file:'):])
+    if spec == 'auto':
+        if shutil.which('pacman'):
+            return PacmanBackend()
+        if shutil.which('dpkg-query'):
+            return DpkgBackend()
+        return None
+    raise UserError(f"unknown package backend: {spec}")
+
+
+def installed_packages(backend: PackageBackend, cache_dir: str) -> Set[str]:
+    '''
+    Query the installed packages, reusing the result cached in cache_dir as
+    long as the package database hasn't been modified.
+    '''
+    try:
+        mtime = os.stat(backend.database_path()).st_mtime_ns
+    except OSError as e:
+        raise UserError(
+            f"cannot read {backend.name} package database " \
+            f"{backend.database_path()}: {e.strerror}")
+    cache_path = os.path.join(cache_dir, f'packages-{backend.name}.json')
+
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache['database'] == backend.database_path() \
+                and cache['mtime'] == mtime:
+            return set(cache['packages'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    packages = backend.installed()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump(
+                {
+                    'database': backend.database_path(),
+                    'mtime': mtime,
+                    'packages': sorted(packages),
+                }, f)
+    except OSError as e:
+        logger.warn(f"cannot write package cache {cache_path}: {e}")
+    return packages
+
+
+def check_system_packages(app_settings: AppSettings,
+                          module_directories: Iterable[str]) -> None:
+    '''
+    Warn about system_packages in modules' headers that aren't installed,
+    querying the package manager at most once.
+    '''
+    required: Dict[str, List[str]] = {}
+    for directory in module_directories:
+        path = os.path.join(directory, app_settings.module_config_filename)
+        packages = read_header(path).get('system_packages') or []
+        if isinstance(packages, str):
+            packages = [packages]
+        if not isinstance(packages, list):
+            raise UserError(f"invalid system_packages in {path}")
+        if packages:
+            required[os.path.basename(directory)] = [str(p) for p in packages]
+
+    if not required:
+        return
+
+    backend = get_backend(app_settings.package_backend)
+    if backend is None:
+        logger.info("No package backend available, skipping package checks")
+        return
+
+    installed = installed_packages(backend, app_settings.cache_dir)
+
+    for module, packages in required.items():
+        missing = [p for p in packages if p not in installed]
+        if missing:
+            logger.warn(f"module \"{module}\" requires system packages " \
+                        f"{', '.join(missing)}, but these are not installed")
@@ -0,0 +1,44 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+
+class OperationRecorder(ABC):
+    '''
+    Receives the operations of a module instead of having them performed
+    on the live system.
+    '''
+    # whether installed files are handed over through add_deferred_file
+    # rather than rendered up front
+    deferred = False
+
+    @abstractmethod
+    def begin_module(self, name: str, directory: str) -> None:
+        pass
+
+    @abstractmethod
+    def add_file(self, src: str, dest: str, content: bytes, mode: int) -> None:
+        pass
+
+    @abstractmethod
+    def add_link(self, src: str, dest: str) -> None:
+        pass
+
+    @abstractmethod
+    def add_command(self,
+                    command: str,
+                    stdin: Optional[str],
+                    wait: bool,
+                    stream=False,
+                    timeout: Optional[float] = None) -> None:
+        pass
+
+    def add_deferred_file(
+        self,
+        src: str,
+        dest: str,
+        binary: bool,
+        load: Callable[[], bytes],
+        mode: int,
+        fingerprint: Optional[Callable[[], str]] = None,
+    ) -> None:
+        self.add_file(src, dest, load(), mode)
@@ -11,6 +11,9 @@ class AppMode(Enum):
     INSTALL = 0
     NEW_MODULE = 1
     INIT = 2
+    BUNDLE = 3
+    APPLY = 4
+    RENDER = 5
 
 
 class AppLogLevel(Enum):
@@ -58,3 +61,15 @@ class AppSettings(Subscriptable):
     init: bool = False
 
     switch_to_root: bool = False
+
+    dest_root: Optional[str] = None
+
+    install_jobs: int = 8
+
+    package_backend: str = "auto"
+
+    bundle_path: Optional[str] = None
+
+    profiles_path: Optional[str] = None
+    output_dir: Optional[str] = None
+    jobs: Optional[int] = None
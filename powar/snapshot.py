@@ -0,0 +1,194 @@
+import copy
+import enum
+import hashlib
+import pathlib
+from typing import AbstractSet, Any, Dict, Iterable, Iterator, Mapping, Optional, Set
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(f"{type(self).__name__} is read-only")
+
+
+class ReadOnlyDict(dict):
+    '''
+    A dict that refuses modification. Still a dict, so that templates and
+    filters such as tojson treat it like one. Copies are plain, editable
+    dicts.
+    '''
+    __setitem__ = __delitem__ = __ior__ = _immutable  # type: ignore
+    clear = pop = popitem = setdefault = update = _immutable  # type: ignore
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> dict:
+        return {
+            copy.deepcopy(k, memo): copy.deepcopy(v, memo)
+            for k, v in self.items()
+        }
+
+    def __reduce__(self):
+        return type(self), (dict(self), )
+
+
+class ReadOnlyList(list):
+    '''
+    A list that refuses modification, rendering exactly like a list.
+    '''
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable  # type: ignore
+    append = extend = insert = pop = remove = clear = _immutable  # type: ignore
+    sort = reverse = _immutable  # type: ignore
+
+    def __copy__(self) -> list:
+        return list(self)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> list:
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return type(self), (list(self), )
+
+
+class ReadOnlySet(set):
+    '''
+    A set that refuses modification, rendering exactly like a set.
+    '''
+    __ior__ = __iand__ = __isub__ = __ixor__ = _immutable  # type: ignore
+    add = discard = remove = pop = clear = update = _immutable  # type: ignore
+    difference_update = intersection_update = _immutable  # type: ignore
+    symmetric_difference_update = _immutable  # type: ignore
+
+    def __repr__(self) -> str:
+        return repr(set(self))
+
+    def __copy__(self) -> set:
+        return set(self)
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> set:
+        return {copy.deepcopy(v, memo) for v in self}
+
+    def __reduce__(self):
+        return type(self), (set(self), )
+
+
+def freeze(value: Any) -> Any:
+    '''
+    Recursively turn dicts, lists and sets into read-only subclasses that
+    still render the same. Tuples keep being tuples, with frozen items.
+    '''
+    if isinstance(value, (ReadOnlyDict, ReadOnlyList, ReadOnlySet)):
+        return value
+    if isinstance(value, Mapping):
+        return ReadOnlyDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(freeze(v) for v in value)
+    if type(value) is tuple:
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, set):
+        return ReadOnlySet(freeze(v) for v in value)
+    return value
+
+
+_SCALARS = (str, bytes, int, float, bool, type(None))
+
+
+def _canonical(value: Any) -> str:
+    # independent of dict ordering and set iteration order
+    if isinstance(value, Mapping):
+        return '{' + ','.join(
+            sorted(f'{_canonical(k)}:{_canonical(v)}'
+                   for k, v in value.items())) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_canonical(v) for v in value) + ']'
+    if isinstance(value, (set, frozenset)):
+        return '<' + ','.join(sorted(_canonical(v) for v in value)) + '>'
+    if type(value) in _SCALARS:
+        return f'{type(value).__name__}:{value!r}'
+    if isinstance(value, enum.Enum):
+        return f'enum:{type(value).__qualname__}.{value.name}'
+    if isinstance(value, pathlib.PurePath):
+        return f'path:{value}'
+    # anything else may not have a repr that is stable across runs
+    raise TypeError(f"cannot hash value of type {type(value).__name__}")
+
+
+def structural_hash(value: Any) -> str:
+    return hashlib.sha256(_canonical(value).encode()).hexdigest()
+
+
+_MISSING = 'missing'
+
+
+class OptsSnapshot:
+    '''
+    Frozen copy of the global opts, shared by all modules of a run. Hashes
+    of individual keys are computed once and reused.
+    '''
+    data: ReadOnlyDict
+    _digests: Dict[Any, str]
+
+    def __init__(self, opts: Mapping):
+        self.data = freeze(opts)
+        self._digests = {}
+
+    def key_digest(self, key: Any) -> str:
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = structural_hash(self.data[key]) \
+                if key in self.data else _MISSING
+            self._digests[key] = digest
+        return digest
+
+    def fingerprint(self, keys: Iterable[Any]) -> str:
+        '''
+        Stable hash of only the given keys (and whether they exist).
+        '''
+        h = hashlib.sha256()
+        for entry in sorted(f'{_canonical(key)}={self.key_digest(key)}'
+                            for key in set(keys)):
+            h.update(entry.encode())
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def reader(self) -> 'OptsReader':
+        return OptsReader(self)
+
+
+class OptsReader(Mapping):
+    '''
+    Read-only view of an OptsSnapshot recording which keys were looked up,
+    including ones that turned out not to exist.
+    '''
+    _snapshot: OptsSnapshot
+    _reads: Set[Any]
+
+    def __init__(self, snapshot: OptsSnapshot):
+        self._snapshot = snapshot
+        self._reads = set()
+
+    def __getitem__(self, key: Any) -> Any:
+        self._reads.add(key)
+        return self._snapshot.data[key]
+
+    def __contains__(self, key: Any) -> bool:
+        self._reads.add(key)
+        return key in self._snapshot.data
+
+    def __iter__(self) -> Iterator[Any]:
+        # whoever iterates depends on the whole set of keys
+        self._reads.update(self._snapshot.data)
+        return iter(self._snapshot.data)
+
+    def __len__(self) -> int:
+        self._reads.update(self._snapshot.data)
+        return len(self._snapshot.data)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self._snapshot.data!r})'
+
+    @property
+    def reads(self) -> AbstractSet[Any]:
+        return frozenset(self._reads)
+
+    def fingerprint(self) -> str:
+        return self._snapshot.fingerprint(self._reads)
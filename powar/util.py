@@ -4,11 +4,19 @@ import logging
 import contextlib
 import dataclasses
 import yaml
-from typing import Union, Any, List, Dict, Tuple, Optional, cast, Iterator, Iterable
+from typing import Union, Any, List, Dict, Tuple, Optional, cast, Iterator, Iterable, IO, Callable, Deque, FrozenSet, Set
 from abc import ABC
 import subprocess
+import functools
+import types
+import threading
+import signal
+import collections
+from getpass import getuser
+from pwd import getpwuid
 
 import jinja2
+import jinja2.meta
 
 logger: logging.Logger = logging.getLogger(__name__)
 
@@ -32,17 +40,134 @@ def realpath(path: str) -> str:
     return os.path.expandvars(os.path.expanduser(path))
 
 
+def rebase_path(path: str, root: Optional[str]) -> str:
+    """Move an absolute path under root, if one is given."""
+    if root is None or not os.path.isabs(path):
+        return path
+    return os.path.join(root, os.path.relpath(path, os.sep))
+
+
+def can_install_without_root(dest: str) -> bool:
+    """Whether dest (or its closest existing parent) is owned by us."""
+    path = dest
+    while not os.path.exists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return getpwuid(os.stat(path).st_uid).pw_name == getuser()
+
+
 @dataclasses.dataclass
 class RunCommandResult:
     stdout: Optional[Union[str, bytes]]
     code: int
 
+STREAM_BUFFER_LINES = 1000
+
+
+class _OutputHandler(logging.Handler):
+    '''
+    Writes streamed command output as is, to the stream it came from.
+    '''
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            out = sys.stderr if getattr(record, 'stream', None) == 'stderr' \
+                else sys.stdout
+            out.write(self.format(record) + '\n')
+            out.flush()
+        except Exception:
+            self.handleError(record)
+
+
+# Output of streamed commands, one record per line with the originating
+# stream in record.stream. Replace its handlers (or let it propagate) to
+# capture or redirect the output.
+output_logger: logging.Logger = logging.getLogger(f'{__name__}.output')
+output_logger.addHandler(_OutputHandler())
+output_logger.propagate = False
+
+
+def _forward_lines(
+    pipe: IO[bytes],
+    stream: Optional[str],
+    buffer: Optional[Deque[bytes]] = None,
+) -> None:
+    for line in iter(lambda: pipe.readline(1 << 16), b''):
+        if stream is not None:
+            output_logger.log(logging.WARNING,
+                              line.decode(errors='replace').rstrip('\n'),
+                              extra={'stream': stream})
+        if buffer is not None:
+            buffer.append(line)
+    pipe.close()
+
+
+def _feed_stdin(pipe: IO[bytes], stdin: Optional[bytes]) -> None:
+    try:
+        if stdin:
+            pipe.write(stdin)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def _kill(process: subprocess.Popen) -> None:
+    """Kill process, and its whole session if it was started in its own."""
+    try:
+        if os.getsid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _stream_process(
+    process: subprocess.Popen,
+    stdin: Optional[bytes],
+    timeout: Optional[float],
+) -> Tuple[bytes, int]:
+    """
+    Log the output of process to output_logger line by line as it arrives
+    (unless running quietly), keeping only the last STREAM_BUFFER_LINES
+    lines of stdout.
+    """
+    echo = output_logger.isEnabledFor(logging.WARNING)
+    stdout: Deque[bytes] = collections.deque(maxlen=STREAM_BUFFER_LINES)
+    threads = [
+        threading.Thread(target=_feed_stdin, args=(process.stdin, stdin)),
+        threading.Thread(target=_forward_lines,
+                         args=(process.stdout, 'stdout' if echo else None,
+                               stdout)),
+        threading.Thread(target=_forward_lines,
+                         args=(process.stderr, 'stderr' if echo else None)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        retcode = process.wait(timeout)
+    except:
+        _kill(process)
+        process.wait()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    return b''.join(stdout), retcode
+
+
 def run_command(
     command: str,
     cwd: str,
     stdin: Optional[bytes] = None,
     decode_stdout=True,
     wait=True,
+    stream=False,
+    timeout: Optional[float] = None,
 ) -> RunCommandResult:
     popenargs = {
         'args': command,
@@ -51,19 +176,29 @@ def run_command(
         'stdout': subprocess.PIPE,
         'stderr': subprocess.PIPE,
         'cwd': cwd,
+        # so that a timeout also kills whatever the shell spawned
+        'start_new_session': timeout is not None,
     }
 
     process = subprocess.Popen(**popenargs)
     if not wait:
         return
     try:
-        stdout, stderr = process.communicate(stdin)
+        if stream:
+            stdout, retcode = _stream_process(process, stdin, timeout)
+        else:
+            stdout, stderr = process.communicate(stdin, timeout)
+            retcode = process.poll()
+    except subprocess.TimeoutExpired:
+        if not stream:
+            _kill(process)
+            process.communicate()
+        raise UserError(f"command timed out after {timeout}s: {command}")
     except:
         process.kill()
         raise
-    retcode = process.poll()
 
-    if retcode:
+    if retcode and not stream:
         try:
             print(stderr.decode())
         except UnicodeDecodeError:
@@ -75,18 +210,81 @@ def run_command(
         return RunCommandResult(stdout=stdout, code=retcode)
 
 
+_code_cache: Dict[str, Tuple[int, types.CodeType]] = {}
+_template_cache: Dict[Tuple[Optional[str], str], jinja2.Template] = {}
+
+
+def compile_file(path: str) -> types.CodeType:
+    """Compile a python file, reusing the result while its mtime is unchanged."""
+    mtime = os.stat(path).st_mtime_ns
+    cached = _code_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        source = f.read()
+    code = compile(source, path, 'exec')
+    _code_cache[path] = (mtime, code)
+    return code
+
+
+@functools.lru_cache(maxsize=None)
+def _jinja_env(directory: Optional[str]) -> jinja2.Environment:
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(directory)) \
+        if directory is not None else jinja2.Environment()
+
+
 def render_template(
     contents: str,
     variables: Dict[str, Any],
     directory: str = None,
 ) -> str:
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(directory)) \
-        if directory is not None else jinja2.Environment()
-    template = env.from_string(contents)
+    key = (directory, contents)
+    template = _template_cache.get(key)
+    if template is None:
+        template = _jinja_env(directory).from_string(contents)
+        _template_cache[key] = template
     rendered = template.render(variables)
     return rendered
 
 
+_names_cache: Dict[Tuple[Optional[str], str], Optional[FrozenSet[str]]] = {}
+
+
+def template_names(
+    contents: str,
+    directory: str = None,
+) -> Optional[FrozenSet[str]]:
+    """
+    Top-level variables a template (and the templates it includes) reads,
+    or None if that can't be determined statically.
+    """
+    key = (directory, contents)
+    if key in _names_cache:
+        return _names_cache[key]
+
+    env = _jinja_env(directory)
+    names: Set[str] = set()
+    seen: Set[str] = set()
+    sources = [contents]
+    try:
+        while sources:
+            ast = env.parse(sources.pop())
+            names |= jinja2.meta.find_undeclared_variables(ast)
+            for name in jinja2.meta.find_referenced_templates(ast):
+                if name is None:
+                    raise LookupError("dynamic template reference")
+                if name not in seen and env.loader is not None:
+                    seen.add(name)
+                    sources.append(env.loader.get_source(env, name)[0])
+        result: Optional[FrozenSet[str]] = frozenset(names)
+    except (LookupError, jinja2.TemplateError):
+        result = None
+
+    _names_cache[key] = result
+    return result
+
+
 @contextlib.contextmanager
 def saved_sys_properties() -> Iterator[None]:
     """Save various sys properties such as sys.path and sys.modules."""
@@ -107,7 +305,7 @@ def read_header(path: str) -> Dict[Any, Any]:
         for line in f:
             if line == '#\n':
                 header_lines.append('\n')
-            if line.startswith('# '):
+            elif line.startswith('# '):
                 header_lines.append(line[2:])
             else:
                 break
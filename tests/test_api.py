@@ -0,0 +1,71 @@
+import jinja2
+import pytest
+
+from powar.api import operations, RenderOp
+from powar.settings import AppSettings
+
+
+def make_tree(tmp_path, modules):
+    config_dir = tmp_path / 'config'
+    config_dir.mkdir()
+    names = ', '.join(f"'{name}'" for name in modules)
+    (config_dir / 'global.py').write_text(f'p.modules({names})\n')
+
+    template_dir = tmp_path / 'templates'
+    for name, files in modules.items():
+        (template_dir / name).mkdir(parents=True)
+        for filename, contents in files.items():
+            (template_dir / name / filename).write_text(contents)
+
+    return AppSettings(template_dir=str(template_dir),
+                       config_dir=str(config_dir),
+                       cache_dir=str(tmp_path / 'cache'))
+
+
+def test_modules_are_evaluated_lazily(tmp_path):
+    marker = tmp_path / 'marker'
+    settings = make_tree(
+        tmp_path, {
+            'first': {
+                'powar.py': "p.install({'t': '/x/t'})\n",
+                't': 'text',
+            },
+            'second': {
+                'powar.py': f"open('{marker}', 'w').close()\n",
+            },
+        })
+
+    ops = operations(settings)
+    assert next(ops).module == 'first'
+    assert not marker.exists()
+    list(ops)
+    assert marker.exists()
+
+
+def test_templates_are_rendered_on_content(tmp_path):
+    settings = make_tree(tmp_path, {
+        'mod': {
+            'powar.py': "p.install({'t': '/x/t'})\n",
+            't': '{{ 1 | no_such_filter }}',
+        },
+    })
+
+    op, = operations(settings)
+    assert isinstance(op, RenderOp)
+    with pytest.raises(jinja2.TemplateError):
+        op.content()
+
+
+def test_local_is_captured_on_install(tmp_path):
+    settings = make_tree(
+        tmp_path, {
+            'mod': {
+                'powar.py': "p.local['x'] = 'a'\n"
+                            "p.install({'t': '/x/t'})\n"
+                            "p.local['x'] = 'b'\n",
+                't': '{{ local.x }}',
+            },
+        })
+
+    op, = operations(settings)
+    assert op.content() == b'a\n'
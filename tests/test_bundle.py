@@ -0,0 +1,54 @@
+import os
+import zipfile
+
+import pytest
+
+from powar.bundle import BundleWriter, BundleApplier
+from powar.settings import AppSettings
+from powar.util import UserError
+
+
+def make_bundle(path, module_dir, marker):
+    with BundleWriter(str(path)) as bundle:
+        bundle.begin_module('mod', str(module_dir))
+        bundle.add_file('conf', '/etc/mod/conf', b'rendered\n', 0o640)
+        bundle.add_file('bin', '/etc/mod/bin', b'\x00\x01', 0o755)
+        bundle.add_link('/etc/mod/conf', '/etc/mod/link')
+        bundle.add_command(f'echo run >> {marker}', None, True)
+
+
+def test_bundle_apply_round_trip(tmp_path):
+    module_dir = tmp_path / 'module'
+    module_dir.mkdir()
+    dest_root = tmp_path / 'root'
+    marker = tmp_path / 'marker'
+    path = tmp_path / 'bundle.zip'
+    make_bundle(path, module_dir, marker)
+
+    settings = AppSettings(dest_root=str(dest_root))
+    BundleApplier(str(path), settings).run()
+
+    conf = dest_root / 'etc/mod/conf'
+    assert conf.read_bytes() == b'rendered\n'
+    assert os.stat(conf).st_mode & 0o7777 == 0o640
+    assert (dest_root / 'etc/mod/bin').read_bytes() == b'\x00\x01'
+    assert os.readlink(dest_root / 'etc/mod/link') == str(conf)
+    assert marker.read_text() == 'run\n'
+
+    # nothing changed, so the guarded command doesn't run again
+    BundleApplier(str(path), settings).run()
+    assert marker.read_text() == 'run\n'
+
+    conf.write_text('edited\n')
+    BundleApplier(str(path), settings).run()
+    assert conf.read_bytes() == b'rendered\n'
+    assert marker.read_text() == 'run\nrun\n'
+
+
+def test_apply_rejects_zips_that_are_not_bundles(tmp_path):
+    path = tmp_path / 'other.zip'
+    with zipfile.ZipFile(str(path), 'w') as f:
+        f.writestr('readme.txt', 'hi')
+
+    with pytest.raises(UserError):
+        BundleApplier(str(path), AppSettings()).run()
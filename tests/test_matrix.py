@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+from powar.matrix import read_profiles, Profile, DirectoryRecorder
+from powar.util import UserError
+
+
+def test_read_profiles(tmp_path):
+    path = tmp_path / 'profiles.yml'
+    path.write_text('laptop:\n'
+                    '  opts: {dpi: 144}\n'
+                    'desktop:\n'
+                    '  global: variants/desktop.py\n'
+                    'plain:\n')
+
+    assert read_profiles(str(path)) == [
+        Profile('laptop', {'dpi': 144}),
+        Profile('desktop', {}, str(tmp_path / 'variants/desktop.py')),
+        Profile('plain', {}),
+    ]
+
+
+@pytest.mark.parametrize('contents', ['- a\n- b\n', 'a: [1]\n'])
+def test_read_profiles_rejects_invalid_files(tmp_path, contents):
+    path = tmp_path / 'profiles.yml'
+    path.write_text(contents)
+    with pytest.raises(UserError):
+        read_profiles(str(path))
+
+
+def test_directory_recorder_keeps_links_inside_its_root(tmp_path):
+    root = tmp_path / 'out'
+    recorder = DirectoryRecorder(str(root))
+    recorder.add_file('conf', '/etc/mod/conf', b'rendered\n', 0o644)
+    recorder.add_link('/etc/mod/conf', '/etc/mod/link')
+    recorder.add_link('conf', '/etc/mod/relative')
+
+    assert (root / 'etc/mod/conf').read_bytes() == b'rendered\n'
+    assert os.readlink(root / 'etc/mod/link') == str(root / 'etc/mod/conf')
+    assert os.readlink(root / 'etc/mod/relative') == 'conf'
+    assert recorder.files == 3
@@ -0,0 +1,60 @@
+import logging
+
+import pytest
+
+from powar.global_config import GlobalConfig
+from powar.module_config import ModuleConfigManager
+from powar.settings import AppSettings
+
+
+def make_module(tmp_path, config, files=()):
+    directory = tmp_path / 'mod'
+    directory.mkdir()
+    (directory / 'powar.py').write_text(config)
+    for name in files:
+        (directory / name).write_text(f'{name}\n')
+    return directory
+
+
+def run_module(tmp_path, directory, install_jobs=8):
+    global_config = GlobalConfig()
+    global_config.modules = ['mod']
+    settings = AppSettings(dest_root=str(tmp_path / 'root'),
+                           install_jobs=install_jobs)
+    ModuleConfigManager(str(directory), global_config, settings).run()
+
+
+def test_last_entry_for_a_destination_wins(tmp_path):
+    files = [f'f{i}' for i in range(20)]
+    entries = ', '.join(f"'{name}': '/x/same'" for name in files)
+    directory = make_module(tmp_path, f'p.install({{{entries}}})\n', files)
+
+    for _ in range(5):
+        run_module(tmp_path, directory)
+        assert (tmp_path / 'root/x/same').read_text() == 'f19\n'
+
+
+def test_installs_are_logged_in_order(tmp_path, caplog):
+    files = [f'f{i}' for i in range(20)]
+    entries = ', '.join(f"'{name}': '/x/{name}'" for name in files)
+    directory = make_module(tmp_path, f'p.install({{{entries}}})\n', files)
+
+    with caplog.at_level(logging.INFO, logger='powar.module_config'):
+        run_module(tmp_path, directory)
+
+    assert [r.getMessage().split(' ')[1] for r in caplog.records] == files
+
+
+def test_pending_entries_are_cancelled_on_failure(tmp_path):
+    files = [f'f{i}' for i in range(20)]
+    entries = ', '.join(f"'{name}': '/x/{name}'" for name in files)
+    directory = make_module(tmp_path,
+                            f"p.install({{'missing': '/x/missing', {entries}}})\n",
+                            files)
+
+    with pytest.raises(FileNotFoundError):
+        run_module(tmp_path, directory, install_jobs=1)
+
+    # at most the entry the worker had already picked up got installed
+    installed = tmp_path / 'root/x'
+    assert not installed.exists() or len(list(installed.iterdir())) <= 1
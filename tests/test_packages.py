@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from powar.packages import FileBackend, check_system_packages, installed_packages
+from powar.settings import AppSettings
+from powar.util import UserError
+
+
+class FailingBackend(FileBackend):
+    name = 'failing'
+
+    def installed(self):
+        return set(self._query('exit 3').split())
+
+
+def test_cache_is_invalidated_by_database_mtime(tmp_path):
+    database = tmp_path / 'installed'
+    database.write_text('bash\n')
+    os.utime(database, ns=(1, 1))
+    backend = FileBackend(str(database))
+    cache_dir = str(tmp_path / 'cache')
+
+    assert installed_packages(backend, cache_dir) == {'bash'}
+
+    # same mtime: the cached result is used
+    database.write_text('bash\nzsh\n')
+    os.utime(database, ns=(1, 1))
+    assert installed_packages(backend, cache_dir) == {'bash'}
+
+    os.utime(database, ns=(2, 2))
+    assert installed_packages(backend, cache_dir) == {'bash', 'zsh'}
+
+
+def test_failed_queries_are_not_cached(tmp_path):
+    database = tmp_path / 'db'
+    database.write_text('')
+    cache_dir = tmp_path / 'cache'
+
+    with pytest.raises(UserError):
+        installed_packages(FailingBackend(str(database)), str(cache_dir))
+    assert not (cache_dir / 'packages-failing.json').exists()
+
+
+def test_missing_database_is_a_user_error(tmp_path):
+    with pytest.raises(UserError):
+        installed_packages(FileBackend(str(tmp_path / 'nope')),
+                           str(tmp_path))
+
+
+def write_module(tmp_path, header):
+    directory = tmp_path / 'mod'
+    directory.mkdir()
+    (directory / 'powar.py').write_text(header)
+    return str(directory)
+
+
+def test_single_system_package_is_not_split(tmp_path, caplog):
+    database = tmp_path / 'installed'
+    database.write_text('v\ni\nm\n')
+    directory = write_module(tmp_path, '# system_packages: vim\n')
+    settings = AppSettings(package_backend=f'file:{database}',
+                           cache_dir=str(tmp_path / 'cache'))
+
+    check_system_packages(settings, [directory])
+    assert 'vim' in caplog.text
+
+
+def test_invalid_system_packages_is_a_user_error(tmp_path):
+    directory = write_module(tmp_path, '# system_packages: {vim: 1}\n')
+    settings = AppSettings(package_backend='none')
+
+    with pytest.raises(UserError):
+        check_system_packages(settings, [directory])
@@ -0,0 +1,75 @@
+import copy
+import pathlib
+
+import jinja2
+import pytest
+
+from powar.snapshot import freeze, structural_hash, OptsSnapshot
+
+
+def render(source, **variables):
+    return jinja2.Template(source).render(freeze(variables))
+
+
+def test_freeze_renders_like_the_original():
+    opts = {'fonts': ['Mono', 'Sans'], 'pair': (1, 2), 'set': {3}}
+    assert render('{{ fonts }} {{ pair }} {{ set }}', **opts) == \
+        "['Mono', 'Sans'] (1, 2) {3}"
+    assert render('{{ d | tojson }}', d={'a': [1, {'b': 2}]}) == \
+        '{"a": [1, {"b": 2}]}'
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda v: v['d'].__setitem__('x', 1),
+    lambda v: v['d'].update(x=1),
+    lambda v: v['l'].append(1),
+    lambda v: v['l'].__setitem__(0, 1),
+    lambda v: v['s'].add(1),
+])
+def test_freeze_is_read_only(mutate):
+    frozen = freeze({'d': {}, 'l': [0], 's': set()})
+    with pytest.raises(TypeError):
+        mutate(frozen)
+
+
+def test_copies_of_frozen_values_are_editable():
+    frozen = freeze({'a': {'b': [1]}})
+    editable = copy.deepcopy(frozen['a'])
+    editable['b'].append(2)
+    assert editable == {'b': [1, 2]}
+    assert frozen['a'] == {'b': [1]}
+
+    shallow = copy.copy(frozen['a'])
+    shallow['c'] = 3
+    assert 'c' not in frozen['a']
+
+
+def test_structural_hash_ignores_ordering():
+    assert structural_hash({'a': 1, 'b': {2, 3}}) == \
+        structural_hash({'b': {3, 2}, 'a': 1})
+    assert structural_hash({'a': 1}) != structural_hash({'a': '1'})
+    assert structural_hash([1, 2]) != structural_hash([2, 1])
+
+
+def test_fingerprint_only_covers_keys_read():
+    reader = OptsSnapshot({'a': 1, 'b': 2}).reader()
+    assert reader['a'] == 1
+    assert 'missing' not in reader
+    assert reader.reads == {'a', 'missing'}
+
+    other = OptsSnapshot({'a': 1, 'b': 'changed'}).reader()
+    other['a']
+    other.get('missing')
+    assert reader.fingerprint() == other.fingerprint()
+
+    changed = OptsSnapshot({'a': 2, 'b': 2}).reader()
+    changed['a']
+    changed.get('missing')
+    assert reader.fingerprint() != changed.fingerprint()
+
+
+def test_structural_hash_rejects_values_without_a_stable_form():
+    assert structural_hash({'p': pathlib.PurePath('/etc')}) == \
+        structural_hash({'p': pathlib.PurePath('/etc')})
+    with pytest.raises(TypeError):
+        structural_hash({'o': object()})
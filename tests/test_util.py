@@ -0,0 +1,62 @@
+import logging
+import time
+
+import pytest
+
+from powar.util import rebase_path, run_command, output_logger, STREAM_BUFFER_LINES, UserError
+
+
+def test_rebase_path():
+    assert rebase_path('/etc/hosts', None) == '/etc/hosts'
+    assert rebase_path('/etc/hosts', '/tmp/root') == '/tmp/root/etc/hosts'
+    assert rebase_path('/', '/tmp/root') == '/tmp/root/.'
+    assert rebase_path('relative/path', '/tmp/root') == 'relative/path'
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def output():
+    handler = RecordingHandler()
+    handlers = output_logger.handlers[:]
+    output_logger.handlers[:] = [handler]
+    yield handler.records
+    output_logger.handlers[:] = handlers
+
+
+def test_streamed_output_goes_through_the_output_logger(tmp_path, output):
+    run_command('echo out; echo err >&2', str(tmp_path), stream=True)
+
+    assert sorted((r.stream, r.getMessage()) for r in output) == \
+        [('stderr', 'err'), ('stdout', 'out')]
+
+
+def test_streamed_stdout_keeps_only_its_tail(tmp_path, output):
+    result = run_command('seq 1 5000', str(tmp_path), stream=True)
+
+    lines = result.stdout.splitlines()
+    assert len(lines) == STREAM_BUFFER_LINES
+    assert lines[-1] == '5000'
+    assert len(output) == 5000
+
+
+def test_streamed_command_is_fed_stdin(tmp_path, output):
+    result = run_command('cat', str(tmp_path), stdin=b'hello\n', stream=True)
+    assert result.stdout == 'hello\n'
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_timeout_kills_the_whole_session(tmp_path, output, stream):
+    # sleep keeps the pipe to cat open unless it is killed too
+    start = time.monotonic()
+    with pytest.raises(UserError):
+        run_command('sleep 30 | cat', str(tmp_path), stream=stream,
+                    timeout=0.5)
+    assert time.monotonic() - start < 5